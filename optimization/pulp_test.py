@@ -1,15 +1,23 @@
 import plotly.graph_objects as go
 import pandas as pd
 import numpy as np
-from pulp import *
+import scipy.sparse as sp
+import highspy
 import geopandas as gpd
+import shapely
+from shapely.ops import unary_union
 import json
 from geodatasets import get_path
-import requests
+import orjson
+import requests_cache
+from datetime import timedelta
+from math import sqrt
+from numba import njit, prange
 
-# Download GeoJSON data for Pennsylvania
+# Download GeoJSON data for Pennsylvania (cached locally, revalidated against the server's ETag once a day)
 url = "https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json"
-counties_geojson = requests.get(url).json()
+session = requests_cache.CachedSession('geojson_cache', expire_after=timedelta(days=1))
+counties_geojson = orjson.loads(session.get(url).content)
 
 # Read the CSV files
 df_substations = pd.read_csv('datasets/pa_substations.csv')
@@ -27,18 +35,13 @@ counties_gdf = counties_gdf.set_crs("EPSG:4326")
 # Filter for Pennsylvania counties (FIPS codes starting with 42)
 pa_counties = counties_gdf[counties_gdf['STATE'] == '42']
 
-# Dissolve county boundaries to create state boundary
-pa_state = pa_counties.dissolve(by='STATE')
+# Merge county boundaries into a single state boundary
+pa_polygon = unary_union(pa_counties.geometry.values)
+shapely.prepare(pa_polygon)
 
-# Convert renewable energy sites to GeoDataFrame
-gdf_renewable = gpd.GeoDataFrame(
-    df_renewable, 
-    geometry=gpd.points_from_xy(df_renewable['longitude'], df_renewable['latitude']),
-    crs="EPSG:4326"
-)
-
-# Perform spatial join to get only the points within Pennsylvania
-df_pa_renewable = gpd.sjoin(gdf_renewable, pa_state, how="inner", predicate="within")
+# Keep only the renewable energy sites within Pennsylvania (one bulk point-in-polygon test)
+in_pa = shapely.contains_xy(pa_polygon, df_renewable['longitude'].to_numpy(), df_renewable['latitude'].to_numpy())
+df_pa_renewable = df_renewable[in_pa]
 
 # Lengths
 num_substations = len(df_pa_sub)
@@ -59,95 +62,130 @@ cable_types = {
     'large': {'capacity_m': 200, 'cost_per_km': 300000}
 }
 
-# Create the problem
-prob = LpProblem("Enhanced_Renewable_to_Substation_Connection", LpMinimize)
-
 # Define indices
-substations_indices = range(len(substations))
-renewable_indices = range(len(renewable))
 cable_type_indices = range(len(cable_types))
 
+# Extract columns once as plain arrays, everything below indexes these instead of the DataFrames
+lat_r, lon_r, cap_m = renewable[['latitude', 'longitude', 'capacity_m']].to_numpy(dtype=np.float64).T
+name_r = renewable['name'].to_numpy()
+lat_s, lon_s = substations[['latitude', 'longitude']].to_numpy(dtype=np.float64).T
+name_s = substations['name'].to_numpy()
+
+# Calculate distances in km: distances[i, j] between renewable i and substation j
+# (equirectangular projection around the renewables' mean latitude, where a degree
+# of longitude is shorter than a degree of latitude; explicit loops so Numba can
+# vectorize them without allocating temporaries)
+@njit(parallel=True, fastmath=True, cache=True)
+def dist_matrix(lat_r, lon_r, lat_s, lon_s, kx, ky, out):
+    for i in prange(lat_r.shape[0]):
+        for j in range(lat_s.shape[0]):
+            dlat = ky * (lat_s[j] - lat_r[i])
+            dlon = kx * (lon_s[j] - lon_r[i])
+            out[i, j] = sqrt(dlat * dlat + dlon * dlon)
+
+mean_lat = np.deg2rad(lat_r.mean())
+kx = 111.320 * np.cos(mean_lat)  # km per degree of longitude
+ky = 110.574  # km per degree of latitude
+distances = np.empty((num_renewable, num_substations))
+dist_matrix(lat_r, lon_r, lat_s, lon_s, kx, ky, distances)
+
+# Cost per km and capacity of each cable type
+costs_k = np.array([cable['cost_per_km'] for cable in cable_types.values()])
+capacities_k = np.array([cable['capacity_m'] for cable in cable_types.values()])
+
+# Only consider the nearest substations for each renewable, long cables are never the cheapest option
+nearest_substations = min(10, num_substations)
+nearest = np.argpartition(distances, nearest_substations - 1, axis=1)[:, :nearest_substations]
+is_near = np.zeros((num_renewable, num_substations), dtype=bool)
+is_near[np.arange(num_renewable)[:, None], nearest] = True
+
+# Relax cable capacity constraints: x[i,j,k] * capacity <= cable capacity * 10
+# As x is binary, this either always holds or forces x[i,j,k] = 0, so instead of
+# adding a row per x[i,j,k] only create the cable types that fit
+fits_cable = cap_m[:, None] <= capacities_k[None, :] * 10  # Multiply by 10 to relax
+
 # Define variables
-# x[i,j,k] = 1 if renewable i is connected to substation j with cable type k, 0 otherwise
-x = LpVariable.dicts("connection", 
-                     ((i, j, k) for i in renewable_indices 
-                      for j in substations_indices 
-                      for k in cable_type_indices), 
-                     cat='Binary')
-
-# Calculate distances
-distances = {(i, j): np.sqrt((substations.iloc[j]['latitude'] - renewable.iloc[i]['latitude'])**2 + 
-                             (substations.iloc[j]['longitude'] - renewable.iloc[i]['longitude'])**2)
-             for i in renewable_indices for j in substations_indices}
-
-# Objective function: Minimize total cost
-prob += lpSum([x[i,j,k] * distances[i,j] * list(cable_types.values())[k]['cost_per_km'] 
-               for i in renewable_indices 
-               for j in substations_indices 
-               for k in cable_type_indices])
-
-# Constraints
+# Columns 0..num_x-1: x[i,j,k] = 1 if renewable i is connected to substation j with cable type k, 0 otherwise
+#   (only the kept (i, j, k) candidates, column c is x[col_i[c], col_j[c], col_k[c]])
+# Columns num_x..num_x+num_renewable-1: slack[i] to allow for unconnected capacity
+num_cable_types = len(cable_types)
+col_i, col_j, col_k = np.nonzero(is_near[:, :, None] & fits_cable[:, None, :])
+num_x = len(col_i)
+num_cols = num_x + num_renewable
+x_cols = np.arange(num_x)
+slack_cols = num_x + np.arange(num_renewable)
+
+# Objective function: Minimize total cost, penalizing unconnected capacity
+# (connection costs are only computed for the kept candidates, not for every (i, j, k))
+big_M = 1e6  # A large number
+col_cost = np.concatenate([distances[col_i, col_j] * costs_k[col_k], cap_m * big_M])
+col_lower = np.zeros(num_cols)
+col_upper = np.concatenate([np.ones(num_x), np.full(num_renewable, highspy.kHighsInf)])
+integrality = [highspy.HighsVarType.kInteger] * num_x + [highspy.HighsVarType.kContinuous] * num_renewable
+
+# Constraints, each family as a sparse block over all columns
 # Increase substation capacity even more (e.g., to 5000 MW or higher if needed)
 substation_capacity = 1000
-for j in substations_indices:
-    prob += lpSum([x[i,j,k] * renewable.iloc[i]['capacity_m'] 
-                   for i in renewable_indices 
-                   for k in cable_type_indices]) <= substation_capacity
-
-# Allow partial connections
-for i in renewable_indices:
-    prob += lpSum([x[i,j,k] for j in substations_indices for k in cable_type_indices]) <= 1
-
-# Relax cable capacity constraints
-for i in renewable_indices:
-    for j in substations_indices:
-        for k in cable_type_indices:
-            prob += x[i,j,k] * renewable.iloc[i]['capacity_m'] <= list(cable_types.values())[k]['capacity_m'] * 10  # Multiply by 10 to relax
-
-# Add a slack variable to allow for unconnected capacity
-slack = LpVariable.dicts("slack", renewable_indices, lowBound=0)
-for i in renewable_indices:
-    prob += lpSum([x[i,j,k] for j in substations_indices for k in cable_type_indices]) + slack[i] == 1
-
-# Update objective function to penalize unconnected capacity
-big_M = 1e6  # A large number
-prob += lpSum([x[i,j,k] * distances[i,j] * list(cable_types.values())[k]['cost_per_km'] 
-               for i in renewable_indices 
-               for j in substations_indices 
-               for k in cable_type_indices]) + \
-        lpSum([slack[i] * renewable.iloc[i]['capacity_m'] * big_M for i in renewable_indices])
+A_sub = sp.coo_matrix((cap_m[col_i], (col_j, x_cols)), shape=(num_substations, num_cols))
+
+# Each renewable is either connected once or its slack takes up the difference
+# (this also allows partial connections, as slack[i] >= 0)
+A_assign = sp.coo_matrix((np.ones(num_cols), (np.concatenate([col_i, np.arange(num_renewable)]),
+                                               np.concatenate([x_cols, slack_cols]))),
+                         shape=(num_renewable, num_cols))
+
+# Stack the blocks into a row-wise (CSR) constraint matrix
+A = sp.vstack([A_sub, A_assign]).tocsr()
+row_lower = np.concatenate([np.full(num_substations, -highspy.kHighsInf), np.ones(num_renewable)])
+row_upper = np.concatenate([np.full(num_substations, substation_capacity), np.ones(num_renewable)])
+
+# Create the problem
+lp = highspy.HighsLp()
+lp.num_col_ = num_cols
+lp.num_row_ = A.shape[0]
+lp.col_cost_ = col_cost
+lp.col_lower_ = col_lower
+lp.col_upper_ = col_upper
+lp.row_lower_ = row_lower
+lp.row_upper_ = row_upper
+lp.a_matrix_.format_ = highspy.MatrixFormat.kRowwise
+lp.a_matrix_.start_ = A.indptr
+lp.a_matrix_.index_ = A.indices
+lp.a_matrix_.value_ = A.data
+lp.integrality_ = integrality
+
+h = highspy.Highs()
+h.passModel(lp)
 
 # After defining the problem but before solving
 print(f"Number of renewable sources: {num_renewable}")
 print(f"Number of substations: {num_substations}")
-print(f"Total renewable capacity: {renewable['capacity_m'].sum()} MW")
+print(f"Total renewable capacity: {cap_m.sum()} MW")
 print(f"Maximum substation capacity: 2000 MW")
-print(f"Largest renewable source: {renewable['capacity_m'].max()} MW")
-print(f"Smallest cable capacity: {min(cable['capacity_m'] for cable in cable_types.values())} MW")
+print(f"Largest renewable source: {cap_m.max()} MW")
+print(f"Smallest cable capacity: {capacities_k.min()} MW")
 
 # Solve the problem
-prob.solve(PULP_CBC_CMD(msg=1, timeLimit=300))  # Set a time limit of 300 seconds
+h.setOptionValue("time_limit", 300.0)  # Set a time limit of 300 seconds
+h.run()
 
 # Check the solution status
-print("Status:", LpStatus[prob.status])
+model_status = h.getModelStatus()
+print("Status:", h.modelStatusToString(model_status))
 
 # Extract results
-if prob.status == 1:  # Optimal solution found
-    connections = []
-    connected_substation_indices = set()
-    total_connected_capacity = 0
-    total_unconnected_capacity = 0
-    for i in renewable_indices:
-        connected = False
-        for j in substations_indices:
-            for k in cable_type_indices:
-                if value(x[i,j,k]) > 0.01:  # Use a small threshold
-                    connections.append((i, j, k))
-                    connected_substation_indices.add(j)
-                    connected = True
-                    total_connected_capacity += renewable.iloc[i]['capacity_m'] * value(x[i,j,k])
-        if not connected:
-            total_unconnected_capacity += renewable.iloc[i]['capacity_m']
+# Also keep the best solution found when the time limit stops the solve (see the status above)
+has_solution = (model_status == highspy.HighsModelStatus.kOptimal or
+                h.getInfo().primal_solution_status == highspy.SolutionStatus.kSolutionStatusFeasible)
+if has_solution:
+    x_sol = np.asarray(h.getSolution().col_value)[:num_x]
+    chosen = np.flatnonzero(x_sol > 0.01)  # Use a small threshold
+    connections = list(zip(col_i[chosen], col_j[chosen], col_k[chosen]))
+    connected_substation_indices = set(col_j[chosen])
+    is_connected = np.zeros(num_renewable, dtype=bool)
+    is_connected[col_i[chosen]] = True
+    total_connected_capacity = (cap_m[col_i[chosen]] * x_sol[chosen]).sum()
+    total_unconnected_capacity = cap_m[~is_connected].sum()
 
     print(f"Total connected capacity: {total_connected_capacity:.2f} MW")
     print(f"Total unconnected capacity: {total_unconnected_capacity:.2f} MW")
@@ -155,15 +193,13 @@ if prob.status == 1:  # Optimal solution found
     print(f"Number of connected substations: {len(connected_substation_indices)}")
 
     # Calculate actual connection cost
-    total_cost = sum(value(x[i,j,k]) * distances[i,j] * list(cable_types.values())[k]['cost_per_km'] 
-                     for i in renewable_indices 
-                     for j in substations_indices 
-                     for k in cable_type_indices)
+    total_cost = float(x_sol @ col_cost[:num_x])
     print(f"Actual connection cost: ${total_cost:,.2f}")
 else:
-    print("No optimal solution found.")
+    print("No feasible solution found.")
     connections = []
     connected_substation_indices = set()
+    total_cost = None
 
 # Filter for only Pennsylvania counties (FIPS codes starting with 42)
 pa_counties = {
@@ -171,6 +207,27 @@ pa_counties = {
     "features": [county for county in counties_geojson["features"] if county["properties"]["STATE"] == "42"]
 }
 
+# Layers with more points than this are drawn as a datashader image instead of individual markers
+max_scatter_points = 5000
+
+def points_image_layer(lons, lats, color):
+    # Rasterize the points in Web Mercator (the map's projection) into a mapbox image layer
+    # (datashader is imported here so runs that stay below the threshold don't pay for it)
+    import datashader as ds
+    import datashader.transfer_functions as tf
+    from datashader.utils import lnglat_to_meters
+
+    x, y = lnglat_to_meters(lons, lats)
+    cvs = ds.Canvas(plot_width=800, plot_height=600, x_range=(x.min(), x.max()), y_range=(y.min(), y.max()))
+    agg = cvs.points(pd.DataFrame({'x': x, 'y': y}), 'x', 'y')
+    img = tf.spread(tf.shade(agg, cmap=[color]), px=2).to_pil()
+    return {
+        'sourcetype': 'image',
+        'source': img,
+        'coordinates': [[lons.min(), lats.max()], [lons.max(), lats.max()],
+                        [lons.max(), lats.min()], [lons.min(), lats.min()]]
+    }
+
 # Create the map
 fig = go.Figure()
 
@@ -185,90 +242,85 @@ fig.add_trace(go.Choroplethmapbox(
     showscale=False
 ))
 
-# Identify connected substations
-connected_substations = set(j for (i, j, k) in connections)
-
-# Create lists for connected and unconnected substations
-connected_lats = []
-connected_lons = []
-connected_names = []
-unconnected_lats = []
-unconnected_lons = []
-unconnected_names = []
-
-for idx, substation in substations.iterrows():
-    if idx in connected_substation_indices:
-        connected_lats.append(substation['latitude'])
-        connected_lons.append(substation['longitude'])
-        connected_names.append(substation['name'])
-    else:
-        unconnected_lats.append(substation['latitude'])
-        unconnected_lons.append(substation['longitude'])
-        unconnected_names.append(substation['name'])
-
-print(f"Number of connected substations: {len(connected_lats)}")
-print(f"Number of unconnected substations: {len(unconnected_lats)}")
+# Mask for connected and unconnected substations (by position, matching the solution's j)
+is_connected_sub = np.zeros(num_substations, dtype=bool)
+is_connected_sub[list(connected_substation_indices)] = True
+num_connected_sub = is_connected_sub.sum()
+num_unconnected_sub = num_substations - num_connected_sub
+
+print(f"Number of connected substations: {num_connected_sub}")
+print(f"Number of unconnected substations: {num_unconnected_sub}")
 
 # Add connected substations
-if connected_lats:
+if num_connected_sub:
     fig.add_trace(go.Scattermapbox(
-        lat=connected_lats,
-        lon=connected_lons,
+        lat=lat_s[is_connected_sub],
+        lon=lon_s[is_connected_sub],
         mode='markers',
         marker=dict(size=10, color='red'),
-        text=connected_names,
+        text=name_s[is_connected_sub],
         hoverinfo='text',
         name='Connected Substations'
     ))
 
-# Add unconnected substations
-if unconnected_lats:
+# Image layers for point sets too large to draw as markers
+mapbox_layers = []
+
+# Add unconnected substations (only shown for context, so rasterized entirely if there are too many)
+if num_unconnected_sub > max_scatter_points:
+    mapbox_layers.append(points_image_layer(lon_s[~is_connected_sub], lat_s[~is_connected_sub], 'grey'))
+elif num_unconnected_sub:
     fig.add_trace(go.Scattermapbox(
-        lat=unconnected_lats,
-        lon=unconnected_lons,
+        lat=lat_s[~is_connected_sub],
+        lon=lon_s[~is_connected_sub],
         mode='markers',
         marker=dict(size=10, color='grey'),  # Light red color
-        text=unconnected_names,
+        text=name_s[~is_connected_sub],
         hoverinfo='text',
         name='Unconnected Substations'
     ))
 
 # Print number of connected and unconnected substations for debugging
-print(f"Number of connected substations: {len(connected_lats)}")
-print(f"Number of unconnected substations: {len(unconnected_lats)}")
+print(f"Number of connected substations: {num_connected_sub}")
+print(f"Number of unconnected substations: {num_unconnected_sub}")
 # Add renewable energy sites
 fig.add_trace(go.Scattermapbox(
-    lat=renewable['latitude'],
-    lon=renewable['longitude'],
+    lat=lat_r,
+    lon=lon_r,
     mode='markers',
     marker=dict(size=10, color='green'),
-    text=renewable['name'] + ' (' + renewable['capacity_m'].astype(str) + ' MW)',
+    text=[f"{name} ({cap} MW)" for name, cap in zip(name_r, cap_m)],
     hoverinfo='text',
     name='Renewable Energy Sites'
 ))
 
-# Add connections
+# Add connections, one trace per cable type with None separating the lines
 cable_colors = ['blue', 'yellow', 'purple']  # Colors for different cable types
+connection_lats = [[] for _ in cable_type_indices]
+connection_lons = [[] for _ in cable_type_indices]
 for i, j, k in connections:
-    renewable_point = renewable.iloc[i]
-    substation_point = substations.iloc[j]
-    
-    fig.add_trace(go.Scattermapbox(
-        lat=[renewable_point['latitude'], substation_point['latitude']],
-        lon=[renewable_point['longitude'], substation_point['longitude']],
-        mode='lines',
-        line=dict(width=2, color=cable_colors[k]),
-        opacity=0.8,
-        hoverinfo='none',
-        showlegend=False
-    ))
+    connection_lats[k] += [lat_r[i], lat_s[j], None]
+    connection_lons[k] += [lon_r[i], lon_s[j], None]
+
+for k in cable_type_indices:
+    if connection_lats[k]:
+        fig.add_trace(go.Scattermapbox(
+            lat=connection_lats[k],
+            lon=connection_lons[k],
+            mode='lines',
+            line=dict(width=2, color=cable_colors[k]),
+            opacity=0.8,
+            hoverinfo='none',
+            showlegend=False
+        ))
 
 # Update the layout to focus on Pennsylvania
 fig.update_layout(
     mapbox_style="carto-positron",
     mapbox=dict(
         center=dict(lat=40.9699, lon=-77.7278),  # Center of Pennsylvania
-        zoom=6.2  # Slightly zoomed out to show the whole state
+        zoom=6.2,  # Slightly zoomed out to show the whole state
+        layers=mapbox_layers
     ),
     margin={"r":0,"t":30,"l":0,"b":0},
     height=800,
@@ -281,8 +333,7 @@ fig.update_layout(
 fig.show()
 
 # Print total cost
-total_cost = sum(value(x[i,j,k]) * distances[i,j] * list(cable_types.values())[k]['cost_per_km'] 
-                 for i in renewable_indices 
-                 for j in substations_indices 
-                 for k in cable_type_indices)
-print(f"Total connection cost: ${total_cost:,.2f}")
\ No newline at end of file
+if total_cost is not None:
+    print(f"Total connection cost: ${total_cost:,.2f}")
+else:
+    print("Total connection cost: n/a (no solution)")
\ No newline at end of file
@@ -1,10 +1,13 @@
 import plotly.graph_objects as go
-import requests
+import orjson
+import requests_cache
+from datetime import timedelta
 import pandas as pd
 
-# Download GeoJSON data for Pennsylvania
+# Download GeoJSON data for Pennsylvania (cached locally, revalidated against the server's ETag once a day)
 url = "https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json"
-counties = requests.get(url).json()
+session = requests_cache.CachedSession('geojson_cache', expire_after=timedelta(days=1))
+counties = orjson.loads(session.get(url).content)
 
 # Filter for only Pennsylvania counties (FIPS codes starting with 42)
 pa_counties = {
@@ -12,6 +15,29 @@ pa_counties = {
     "features": [county for county in counties["features"] if county["properties"]["STATE"] == "42"]
 }
 
+# Layers with more points than this are drawn as a datashader image instead of individual markers
+max_scatter_points = 5000
+max_hover_points = 500  # Largest points still drawn as hoverable markers on a rasterized layer
+
+def points_image_layer(lons, lats, color):
+    # Rasterize the points in Web Mercator (the map's projection) into a mapbox image layer
+    # (datashader is imported here so runs that stay below the threshold don't pay for it)
+    import datashader as ds
+    import datashader.transfer_functions as tf
+    from datashader.utils import lnglat_to_meters
+
+    x, y = lnglat_to_meters(lons, lats)
+    cvs = ds.Canvas(plot_width=800, plot_height=600, x_range=(x.min(), x.max()), y_range=(y.min(), y.max()))
+    agg = cvs.points(pd.DataFrame({'x': x, 'y': y}), 'x', 'y')
+    img = tf.spread(tf.shade(agg, cmap=[color]), px=2).to_pil()
+    return {
+        'sourcetype': 'image',
+        'source': img,
+        'coordinates': [[lons.min(), lats.max()], [lons.max(), lats.max()],
+                        [lons.max(), lats.min()], [lons.min(), lats.min()]]
+    }
+
+
 # Read the CSV files
 df_substations = pd.read_csv('datasets/pa_substations.csv')
 df_renewable = pd.read_csv('datasets/irena_roughly_pa_renewable_power_plants.csv')
@@ -19,12 +45,13 @@ df_renewable = pd.read_csv('datasets/irena_roughly_pa_renewable_power_plants.csv
 # Filter for Pennsylvania substations
 df_pa_sub = df_substations[df_substations['STATE'] == 'PA']
 
-# Filter for Pennsylvania renewable energy sites
-df_pa_renewable = df_renewable[df_renewable['country'] == 'United States of America']
-df_pa_renewable = df_pa_renewable[(df_pa_renewable['latitude'] >= 39.7) & 
-                                  (df_pa_renewable['latitude'] <= 42.5) &
-                                  (df_pa_renewable['longitude'] >= -80.5) & 
-                                  (df_pa_renewable['longitude'] <= -74.7)]
+# Filter for Pennsylvania renewable energy sites (single mask over the raw arrays)
+lat = df_renewable['latitude'].to_numpy()
+lon = df_renewable['longitude'].to_numpy()
+in_pa = ((df_renewable['country'].to_numpy() == 'United States of America') &
+         (lat >= 39.7) & (lat <= 42.5) &
+         (lon >= -80.5) & (lon <= -74.7))
+df_pa_renewable = df_renewable[in_pa]
 
 # Create the map
 fig = go.Figure()
@@ -40,32 +67,45 @@ fig.add_trace(go.Choroplethmapbox(
     showscale=False
 ))
 
-# Add substations
+# Image layers for point sets too large to draw as markers
+mapbox_layers = []
+
+# Add substations (rasterized if there are too many, keeping the highest voltage ones hoverable)
+df_sub_markers = df_pa_sub
+if len(df_pa_sub) > max_scatter_points:
+    mapbox_layers.append(points_image_layer(df_pa_sub['LONGITUDE'].to_numpy(), df_pa_sub['LATITUDE'].to_numpy(), 'red'))
+    df_sub_markers = df_pa_sub.nlargest(max_hover_points, 'MAX_VOLT')
+
 fig.add_trace(go.Scattermapbox(
-    lat=df_pa_sub['LATITUDE'],
-    lon=df_pa_sub['LONGITUDE'],
+    lat=df_sub_markers['LATITUDE'],
+    lon=df_sub_markers['LONGITUDE'],
     mode='markers',
     marker=dict(
         size=5,
         color='red',
         opacity=0.7
     ),
-    text=df_pa_sub['NAME'],
+    text=df_sub_markers['NAME'],
     hoverinfo='text',
     name='Substations'
 ))
 
-# Add renewable energy sites
+# Add renewable energy sites (rasterized if there are too many, keeping the largest ones hoverable)
+df_renewable_markers = df_pa_renewable
+if len(df_pa_renewable) > max_scatter_points:
+    mapbox_layers.append(points_image_layer(df_pa_renewable['longitude'].to_numpy(), df_pa_renewable['latitude'].to_numpy(), 'green'))
+    df_renewable_markers = df_pa_renewable.nlargest(max_hover_points, 'capacity_m')
+
 fig.add_trace(go.Scattermapbox(
-    lat=df_pa_renewable['latitude'],
-    lon=df_pa_renewable['longitude'],
+    lat=df_renewable_markers['latitude'],
+    lon=df_renewable_markers['longitude'],
     mode='markers',
     marker=dict(
         size=5,
         color='green',
         opacity=0.7
     ),
-    text=df_pa_renewable['name'] + '<br>' + df_pa_renewable['primary_fu'],
+    text=df_renewable_markers['name'] + '<br>' + df_renewable_markers['primary_fu'],
     hoverinfo='text',
     name='Renewable Energy Sites'
 ))
@@ -75,7 +115,8 @@ fig.update_layout(
     mapbox_style="carto-positron",
     mapbox=dict(
         center=dict(lat=40.9699, lon=-77.7278),  # Center of Pennsylvania
-        zoom=6.5
+        zoom=6.5,
+        layers=mapbox_layers
     ),
     margin={"r":0,"t":30,"l":0,"b":0},
     autosize=True,
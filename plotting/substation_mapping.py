@@ -3,8 +3,10 @@ from mpl_toolkits.basemap import Basemap
 import pandas as pd
 import numpy as np
 import geopandas as gpd
+import shapely
 import contextily as ctx
 import osmnx as ox
+import os
 
 # Read the CSV files
 df_substations = pd.read_csv('datasets/pa_substations.csv')
@@ -28,19 +30,28 @@ m.shadedrelief()
 m.drawcountries(color='black')
 m.drawstates(color='black')
 
-# Get major highways for Pennsylvania
-highways = ox.geometries_from_place("Pennsylvania, USA", tags={"highway": ["motorway", "trunk", "primary"]})
-highways = highways.to_crs(epsg=4326)  # Convert to WGS84
+# Get major highways for Pennsylvania (Overpass responses are cached in cache/, and the
+# highway geometries themselves in a feather file so later runs skip the download entirely)
+ox.settings.use_cache = True
+ox.settings.cache_folder = 'cache'
+highways_path = 'cache/pa_highways.feather'
+if os.path.exists(highways_path):
+    highways = gpd.read_feather(highways_path)
+else:
+    highways = ox.geometries_from_place("Pennsylvania, USA", tags={"highway": ["motorway", "trunk", "primary"]})
+    highways = highways.to_crs(epsg=4326)  # Convert to WGS84
+    highways = highways[['geometry']].reset_index(drop=True)
+    highways.to_feather(highways_path)
 
-# Plot highways
-for _, row in highways.iterrows():
-    if row.geometry.geom_type == 'LineString':
-        x, y = m(row.geometry.xy[0], row.geometry.xy[1])
-        m.plot(x, y, 'gray', linewidth=0.5, alpha=0.7)
-    elif row.geometry.geom_type == 'MultiLineString':
-        for line in row.geometry:
-            x, y = m(line.xy[0], line.xy[1])
-            m.plot(x, y, 'gray', linewidth=0.5, alpha=0.7)
+# Plot highways as a single line, with NaN breaking it between the individual LineStrings
+lines = shapely.get_parts(highways.geometry.values)  # Split MultiLineStrings into LineStrings
+lines = lines[shapely.get_type_id(lines) == 1]  # Keep only LineStrings
+coords, line_index = shapely.get_coordinates(lines, return_index=True)
+x_hwy, y_hwy = m(coords[:, 0], coords[:, 1])
+breaks = np.flatnonzero(np.diff(line_index)) + 1
+x_hwy = np.insert(x_hwy, breaks, np.nan)
+y_hwy = np.insert(y_hwy, breaks, np.nan)
+m.plot(x_hwy, y_hwy, 'gray', linewidth=0.5, alpha=0.7)
 
 # Plot substations
 x_sub, y_sub = m(df_pa_sub['LONGITUDE'].values.tolist(), df_pa_sub['LATITUDE'].values.tolist())
@@ -48,13 +59,14 @@ scatter_sub = m.scatter(x_sub, y_sub, s=20, c=df_pa_sub['MAX_VOLT'], cmap='virid
                         norm=plt.Normalize(vmin=df_pa_sub['MAX_VOLT'].min(), vmax=df_pa_sub['MAX_VOLT'].max()),
                         edgecolor='black', linewidth=0.5, marker='s', label='Substations')
 
-# Plot renewable energy sites
+# Plot renewable energy sites (project all of them once, then select each type with a mask)
+x_ren, y_ren = m(df_pa_renewable['longitude'].to_numpy(), df_pa_renewable['latitude'].to_numpy())
+fuel = df_pa_renewable['primary_fu'].to_numpy()
 renewable_types = df_pa_renewable['primary_fu'].unique()
 colors = plt.cm.Set1(np.linspace(0, 1, len(renewable_types)))
 for renewable_type, color in zip(renewable_types, colors):
-    df_type = df_pa_renewable[df_pa_renewable['primary_fu'] == renewable_type]
-    x_ren, y_ren = m(df_type['longitude'].values.tolist(), df_type['latitude'].values.tolist())
-    m.scatter(x_ren, y_ren, s=50, c=[color], edgecolor='black', linewidth=0.5, marker='^', label=f'{renewable_type} Energy')
+    is_type = fuel == renewable_type
+    m.scatter(x_ren[is_type], y_ren[is_type], s=50, c=[color], edgecolor='black', linewidth=0.5, marker='^', label=f'{renewable_type} Energy')
 
 # Add major cities
 cities = {
@@ -70,9 +82,11 @@ cities = {
     'Altoona': (-78.3947, 40.5186)
 }
 
-for city, coords in cities.items():
-    x, y = m(coords[0], coords[1])
-    plt.plot(x, y, 'ko', markersize=5)
+# Project all cities at once, then only loop to add the labels
+city_lons, city_lats = np.array(list(cities.values())).T
+x_city, y_city = m(city_lons, city_lats)
+plt.plot(x_city, y_city, 'ko', markersize=5)
+for city, x, y in zip(cities, x_city, y_city):
     plt.text(x, y, city, fontsize=8, ha='right', va='bottom')
 
 plt.title('Substations, Renewable Energy Sites in Pennsylvania')